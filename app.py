@@ -1,21 +1,144 @@
 import json
+import os
 import sqlite3
+import threading
 import time
+from contextlib import closing
 
-from flask import Flask, request
+from flask import Blueprint, Flask, current_app, request
 from flask.json import jsonify
 
-from utils import median
+from db import SENSOR_TYPES, has_unique_index, init_db, prewarm_page_cache, warm_hot_window
+from utils import Counters, RecentKeys, median
 
-app = Flask(__name__)
+readings = Blueprint('readings', __name__)
 
-# Setup the SQLite DB
-conn = sqlite3.connect('database.db')
-conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
-conn.close()
 
+def create_app(config=None):
+    """
+    Build the API. Nothing touches the SQLite DB until the first request,
+    which also starts the background warm-up when WARM_UP is set.
+
+    Configuration:
+    * DATABASE -> The path of the SQLite DB (test_database.db when TESTING)
+    * RECENT_READINGS_SIZE -> How many recently ingested readings are kept
+        to answer retries without a round trip to the DB
+    * WARM_UP -> Warm the DB up in the background of each serving process
+    * WARM_UP_PAGE_CACHE -> Read the whole DB file into the OS page cache,
+        turn off for DBs larger than RAM to only warm up the hot devices
+    * WARM_UP_HOT_DEVICES -> How many of the most active devices to warm up
+        when WARM_UP_PAGE_CACHE is off
+    * WARM_UP_HOT_WINDOW -> The seconds of recent readings to warm up for them
+    """
+
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE='database.db',
+        RECENT_READINGS_SIZE=100000,
+        WARM_UP=False,
+        WARM_UP_PAGE_CACHE=True,
+        WARM_UP_HOT_DEVICES=100,
+        WARM_UP_HOT_WINDOW=24 * 60 * 60,
+    )
+    if config:
+        app.config.update(config)
+
+    app.register_blueprint(readings)
+
+    # The SQLite DBs whose schema has been set up by this app
+    app.extensions['initialised_dbs'] = set()
+    app.extensions['initialised_dbs_lock'] = threading.Lock()
+
+    # Readings recently ingested, so that most device retries are answered
+    # without a round trip to the database
+    app.extensions['recent_readings'] = RecentKeys(maxsize=app.config['RECENT_READINGS_SIZE'])
+
+    # Counters of the readings accepted and of the duplicates rejected
+    app.extensions['ingest_stats'] = Counters('accepted', 'duplicates_filtered', 'duplicates_db')
+
+    # /ready/ reports 503 until this is set
+    app.extensions['warm_up'] = threading.Event()
+    app.extensions['warm_up_lock'] = threading.Lock()
+    app.extensions['warm_up_pid'] = None
+    if app.config['WARM_UP']:
+        app.before_request(start_warm_up)
+    else:
+        app.extensions['warm_up'].set()
+
+    return app
+
+
+def db_path(app):
+    if app.config['TESTING']:
+        return 'test_database.db'
+    return app.config['DATABASE']
+
+
+def connect_db(app=None):
+    """
+    Open a connection to the SQLite DB of the app, setting up its schema
+    the first time this process uses it.
+    """
+
+    app = app or current_app
+    path = db_path(app)
+    conn = sqlite3.connect(path)
+
+    initialised_dbs = app.extensions['initialised_dbs']
+    if path not in initialised_dbs:
+        with app.extensions['initialised_dbs_lock']:
+            if path not in initialised_dbs:
+                if not init_db(conn):
+                    app.logger.warning('%s holds duplicate readings, run dedupe.py to enable idempotent ingest', path)
+                initialised_dbs.add(path)
+
+    return conn
 
-@app.route('/devices/<string:device_uuid>/readings/', methods=['POST', 'GET'])
+
+def start_warm_up():
+    """
+    Start the warm-up on the first request a process serves, so that each
+    worker forked from a preloaded app warms up on its own and a reloader
+    watching for code changes does not.
+    """
+
+    app = current_app._get_current_object()
+    if app.extensions['warm_up_pid'] == os.getpid():
+        return
+
+    with app.extensions['warm_up_lock']:
+        if app.extensions['warm_up_pid'] != os.getpid():
+            app.extensions['warm_up_pid'] = os.getpid()
+            threading.Thread(target=warm_up, args=(app,), daemon=True).start()
+
+
+def warm_up(app):
+    """
+    Load the SQLite DB into the OS page cache, so the first requests after
+    boot are not cold.
+
+    Connections are opened per request, so SQLite's own cache does not
+    outlive the warm-up and only the OS page cache stays warm. A DB that
+    fits in RAM is read whole. For one that does not, turn
+    WARM_UP_PAGE_CACHE off to only read the pages the most active devices hit.
+    """
+
+    started = time.time()
+    try:
+        with closing(connect_db(app)) as conn:
+            if app.config['WARM_UP_PAGE_CACHE']:
+                prewarm_page_cache(db_path(app))
+                app.logger.info('warmed up the page cache in %.2fs', time.time() - started)
+            else:
+                devices = warm_hot_window(conn, app.config['WARM_UP_HOT_DEVICES'], app.config['WARM_UP_HOT_WINDOW'])
+                app.logger.info('warmed up %d devices in %.2fs', len(devices), time.time() - started)
+    except Exception:
+        app.logger.exception('warm-up failed, serving cold')
+    finally:
+        app.extensions['warm_up'].set()
+
+
+@readings.route('/devices/<string:device_uuid>/readings/', methods=['POST', 'GET'])
 def request_device_readings(device_uuid):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
@@ -26,17 +149,19 @@ def request_device_readings(device_uuid):
     * date_created -> The epoch date of the sensor reading.
         If none provided, we set to now.
 
+    POSTing a reading that already exists for the same type and
+    date_created is acknowledged with a 200 and not stored again.
+    Readings without a date_created are always stored: a retry of one
+    cannot be told apart from a new reading.
+
     Optional Query Parameters:
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
     """
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -49,21 +174,44 @@ def request_device_readings(device_uuid):
 
         sensor_type = post_data.get('type', None)
         value = post_data.get('value', None)
-        date_created = post_data.get('date_created', int(time.time()))
+        date_created = post_data.get('date_created', None)
 
-        if not sensor_type or sensor_type not in ('temperature', 'humidity'):
+        if not sensor_type or sensor_type not in SENSOR_TYPES:
             return 'the sensor type is not valid', 400
 
         if not value or 100 < value or 0 > value:
             return 'the sensor value is not in the mandatory range of 0-100', 400
 
-        # Insert data into db
-        cur.execute('INSERT INTO readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+        recent_readings = current_app.extensions['recent_readings']
+        ingest_stats = current_app.extensions['ingest_stats']
+
+        if date_created is None:
+            cur.execute('INSERT INTO readings (device_uuid,type,value,date_created,client_dated) VALUES (?,?,?,?,NULL)',
+                        (device_uuid, sensor_type, value, int(time.time())))
+            conn.commit()
+            ingest_stats.increment('accepted')
+            return 'success', 201
+
+        # Retried uploads of a recent reading are acknowledged straight away
+        key = (device_uuid, sensor_type, date_created)
+        if key in recent_readings:
+            ingest_stats.increment('duplicates_filtered')
+            return 'duplicate reading ignored', 200
+
+        # Insert data into db, the unique index rejects older duplicates
+        cur.execute('INSERT OR IGNORE INTO readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
                     (device_uuid, sensor_type, value, date_created))
+        inserted = cur.rowcount
 
         conn.commit()
+        recent_readings.add(key)
+
+        if not inserted:
+            ingest_stats.increment('duplicates_db')
+            return 'duplicate reading ignored', 200
 
         # Return success
+        ingest_stats.increment('accepted')
         return 'success', 201
     else:
         # Grab the query parameters (if any)
@@ -94,7 +242,7 @@ def request_device_readings(device_uuid):
         return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/min/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/min/', methods=['GET'])
 def request_device_readings_min(device_uuid):
     """
     This endpoint allows clients to GET the min sensor reading for a device.
@@ -110,18 +258,15 @@ def request_device_readings_min(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         end = post_data.get('end', None)
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -145,7 +290,7 @@ def request_device_readings_min(device_uuid):
     return jsonify(dict(zip(['device_uuid', 'type', 'value', 'date_created'], row))), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/max/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/max/', methods=['GET'])
 def request_device_readings_max(device_uuid):
     """
     This endpoint allows clients to GET the max sensor reading for a device.
@@ -161,18 +306,15 @@ def request_device_readings_max(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         end = post_data.get('end', None)
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -196,7 +338,7 @@ def request_device_readings_max(device_uuid):
     return jsonify(dict(zip(['device_uuid', 'type', 'value', 'date_created'], row))), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/median/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/median/', methods=['GET'])
 def request_device_readings_median(device_uuid):
     """
     This endpoint allows clients to GET the median sensor reading for a device.
@@ -212,18 +354,15 @@ def request_device_readings_median(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         end = post_data.get('end', None)
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -248,7 +387,7 @@ def request_device_readings_median(device_uuid):
     return str(median(rows)), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/mean/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/mean/', methods=['GET'])
 def request_device_readings_mean(device_uuid):
     """
     This endpoint allows clients to GET the mean sensor readings for a device.
@@ -264,18 +403,15 @@ def request_device_readings_mean(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         end = post_data.get('end', None)
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -298,7 +434,7 @@ def request_device_readings_mean(device_uuid):
     return str(row[0]), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/mode/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/mode/', methods=['GET'])
 def request_device_readings_mode(device_uuid):
     """
     This endpoint allows clients to GET the mode sensor reading value for a device.
@@ -314,18 +450,15 @@ def request_device_readings_mode(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         end = post_data.get('end', None)
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -350,7 +483,7 @@ def request_device_readings_mode(device_uuid):
     return str(row[0]), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/quartiles/', methods=['GET'])
+@readings.route('/devices/<string:device_uuid>/readings/quartiles/', methods=['GET'])
 def request_device_readings_quartiles(device_uuid):
     """
     This endpoint allows clients to GET the 1st and 3rd quartile
@@ -365,7 +498,7 @@ def request_device_readings_quartiles(device_uuid):
     if request.data:
         post_data = json.loads(request.data)
         type = post_data.get('type', None)
-        if not type or type not in ('temperature', 'humidity'):
+        if not type or type not in SENSOR_TYPES:
             return 'error on the required type data', 400
         start = post_data.get('start', None)
         if not start:
@@ -376,11 +509,8 @@ def request_device_readings_quartiles(device_uuid):
     else:
         return 'missing data in the request parameters', 400
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
+    # Open the connection to the db that we want
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -407,5 +537,37 @@ def request_device_readings_quartiles(device_uuid):
     return str(lowerQ) + "," + str(upperQ), 200
 
 
+@readings.route('/ready/', methods=['GET'])
+def request_ready():
+    """
+    This endpoint allows load balancers to GET whether the API is done
+    warming up and ready to serve traffic.
+    """
+
+    if not current_app.extensions['warm_up'].is_set():
+        return 'warming up', 503
+
+    return 'ready', 200
+
+
+@readings.route('/stats/ingest/', methods=['GET'])
+def request_ingest_stats():
+    """
+    This endpoint allows clients to GET the number of readings accepted
+    and of duplicate readings rejected since the API started, and whether
+    the db has the unique index that rejects older duplicates.
+    """
+
+    conn = connect_db()
+    stats = current_app.extensions['ingest_stats'].as_dict()
+    stats['unique_index'] = has_unique_index(conn)
+    conn.close()
+
+    return jsonify(stats), 200
+
+
+# WSGI servers import this app, set WARM_UP=1 in their environment to warm up
+app = create_app({'WARM_UP': __name__ == '__main__' or os.environ.get('WARM_UP') == '1'})
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,105 @@
+import sqlite3
+
+# The sensor types the API accepts readings for
+SENSOR_TYPES = ('temperature', 'humidity')
+
+# A reading is identified by the device, the sensor type and the epoch it was
+# taken at: a device retrying an upload sends the same triple again. Readings
+# dated by the server when they came in have a NULL client_dated, and as
+# NULLs are all distinct in a unique index they are never deduplicated.
+READINGS_TABLE = ('CREATE TABLE IF NOT EXISTS readings '
+                  '(device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER, client_dated INTEGER DEFAULT 1)')
+READINGS_UNIQUE_INDEX_NAME = 'readings_unique_client_reading'
+READINGS_UNIQUE_INDEX = ('CREATE UNIQUE INDEX IF NOT EXISTS ' + READINGS_UNIQUE_INDEX_NAME + ' '
+                         'ON readings (device_uuid, type, date_created, client_dated)')
+
+
+def init_db(conn):
+    """
+    Create the readings table and its uniqueness index.
+
+    Returns False when the index could not be created because the table
+    already holds duplicate readings (run dedupe.py to clean them up).
+    """
+    conn.execute(READINGS_TABLE)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(readings)')]
+    if 'client_dated' not in columns:
+        try:
+            conn.execute('ALTER TABLE readings ADD COLUMN client_dated INTEGER DEFAULT 1')
+        except sqlite3.OperationalError as e:
+            # Another process added it since we looked
+            if 'duplicate column name' not in str(e):
+                raise
+    try:
+        conn.execute(READINGS_UNIQUE_INDEX)
+    except sqlite3.IntegrityError:
+        return False
+    finally:
+        conn.commit()
+    return True
+
+
+def has_unique_index(conn):
+    """
+    Whether the uniqueness index exists, without which duplicate readings
+    older than the recent readings filter are stored again.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (READINGS_UNIQUE_INDEX_NAME,))
+    return cur.fetchone() is not None
+
+
+def dedupe_readings(conn):
+    """
+    Delete duplicate readings dated by the client, keeping the first one
+    inserted for each (device_uuid, type, date_created), then install the
+    uniqueness index.
+
+    Returns the number of rows removed.
+    """
+    cur = conn.cursor()
+    cur.execute('DELETE FROM readings WHERE client_dated IS NOT NULL AND rowid NOT IN '
+                '(SELECT MIN(rowid) FROM readings WHERE client_dated IS NOT NULL '
+                'GROUP BY device_uuid, type, date_created)')
+    removed = cur.rowcount
+    conn.execute(READINGS_UNIQUE_INDEX)
+    conn.commit()
+    return removed
+
+
+def prewarm_page_cache(path, chunk_size=1024 * 1024):
+    """
+    Read the DB file once so its pages are served from the OS page cache.
+    """
+    with open(path, 'rb') as db_file:
+        while db_file.read(chunk_size):
+            pass
+
+
+def warm_hot_window(conn, devices, window):
+    """
+    Run the readings queries of the most active devices over the last
+    `window` seconds of data, so the index and table pages they hit are in
+    the OS page cache before the first requests come in. Meant for DBs too
+    large to be read whole by prewarm_page_cache.
+
+    Returns the devices warmed up, most active first.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT MAX(date_created) FROM readings')
+    latest = cur.fetchone()[0]
+    if latest is None:
+        return []
+    since = latest - window
+
+    cur.execute('SELECT device_uuid FROM readings WHERE date_created >= ? '
+                'GROUP BY device_uuid ORDER BY COUNT(*) DESC LIMIT ?', (since, devices))
+    hot_devices = [row[0] for row in cur.fetchall()]
+
+    for device_uuid in hot_devices:
+        for sensor_type in SENSOR_TYPES:
+            cur.execute('SELECT * FROM readings WHERE device_uuid = ? AND type = ? AND date_created >= ?',
+                        (device_uuid, sensor_type, since))
+            cur.fetchall()
+
+    return hot_devices
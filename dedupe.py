@@ -0,0 +1,25 @@
+"""
+One-off tool removing the duplicate readings uploaded before ingest was
+made idempotent.
+
+Usage: python dedupe.py [database.db]
+"""
+import sqlite3
+import sys
+
+from db import dedupe_readings, init_db
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else 'database.db'
+
+    conn = sqlite3.connect(path)
+    init_db(conn)
+    removed = dedupe_readings(conn)
+    conn.close()
+
+    print('removed {} duplicate readings from {}'.format(removed, path))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
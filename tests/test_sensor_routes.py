@@ -1,10 +1,14 @@
 import json
+import os
 import pytest
+import shutil
 import sqlite3
+import tempfile
 import time
 import unittest
 
-from app import app
+from app import create_app
+from db import dedupe_readings, init_db, warm_hot_window
 
 class SensorRoutesTestCases(unittest.TestCase):
 
@@ -12,7 +16,7 @@ class SensorRoutesTestCases(unittest.TestCase):
         # Setup the SQLite DB
         conn = sqlite3.connect('test_database.db')
         conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        init_db(conn)
         
         self.device_uuid = 'test_device'
 
@@ -31,9 +35,9 @@ class SensorRoutesTestCases(unittest.TestCase):
                     ('other_uuid', 'temperature', 22, int(time.time())))
         conn.commit()
 
-        app.config['TESTING'] = True
+        self.app = create_app({'TESTING': True})
 
-        self.client = app.test_client
+        self.client = self.app.test_client
 
     def test_device_readings_get(self):
         # Given a device UUID
@@ -262,3 +266,238 @@ class SensorRoutesTestCases(unittest.TestCase):
         res = request.data.decode('utf-8')
 
         self.assertTrue(res == '22,100')
+
+    def test_device_readings_post_duplicate(self):
+        # Given a reading that has just been uploaded
+        reading = json.dumps({
+            'type': 'temperature',
+            'value': 30,
+            'date_created': 1000
+        })
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+        self.assertEqual(request.status_code, 201)
+
+        # When the device retries the upload
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+
+        # Then it is acknowledged without being stored again
+        self.assertEqual(request.status_code, 200)
+
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid = ?', (self.device_uuid,))
+        self.assertEqual(cur.fetchone()[0], 4)
+
+        ingest_stats = self.app.extensions['ingest_stats']
+        self.assertEqual(ingest_stats['accepted'], 1)
+        self.assertEqual(ingest_stats['duplicates_filtered'], 1)
+
+    def test_device_readings_post_duplicate_in_db(self):
+        # Given a reading that is in the db but not in the recent readings
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                    (self.device_uuid, 'humidity', 40, 1000))
+        conn.commit()
+
+        # When the same reading is uploaded
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'humidity',
+                'value': 40,
+                'date_created': 1000
+            }))
+
+        # Then it is acknowledged without being stored again
+        self.assertEqual(request.status_code, 200)
+
+        cur.execute('select count(*) from readings where device_uuid = ? and type = ?', (self.device_uuid, 'humidity'))
+        self.assertEqual(cur.fetchone()[0], 1)
+
+        request = self.client().get('/stats/ingest/')
+        self.assertEqual(request.json, {'accepted': 0, 'duplicates_filtered': 0, 'duplicates_db': 1, 'unique_index': True})
+
+    def test_ingest_stats_without_unique_index(self):
+        # Given a db still holding duplicate readings
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP INDEX readings_unique_client_reading')
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('other_uuid', 'temperature', 22, 1000))
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('other_uuid', 'temperature', 22, 1000))
+        conn.commit()
+
+        # When we check the ingest stats
+        request = self.client().get('/stats/ingest/')
+
+        # Then they report that duplicates are not rejected by the db
+        self.assertEqual(request.status_code, 200)
+        self.assertFalse(request.json['unique_index'])
+
+    def test_device_readings_post_duplicate_past_recent_readings(self):
+        # Given an app remembering a single recent reading
+        small_app = create_app({'TESTING': True, 'RECENT_READINGS_SIZE': 1})
+        client = small_app.test_client()
+        first = json.dumps({'type': 'temperature', 'value': 30, 'date_created': 1000})
+        second = json.dumps({'type': 'temperature', 'value': 30, 'date_created': 2000})
+        client.post('/devices/{}/readings/'.format(self.device_uuid), data=first)
+        client.post('/devices/{}/readings/'.format(self.device_uuid), data=second)
+
+        # When the first reading is retried
+        request = client.post('/devices/{}/readings/'.format(self.device_uuid), data=first)
+
+        # Then it has left the recent readings and is rejected by the db
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(small_app.extensions['ingest_stats']['duplicates_db'], 1)
+
+    def test_device_readings_post_undated(self):
+        # Given a reading without a date_created
+        reading = json.dumps({
+            'type': 'humidity',
+            'value': 30
+        })
+
+        # When it is uploaded twice within the same second
+        first = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+        second = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+
+        # Then both uploads are stored, as they cannot be told apart from two readings
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid = ? and type = ?', (self.device_uuid, 'humidity'))
+        self.assertEqual(cur.fetchone()[0], 2)
+
+    def test_device_readings_post_separate_apps(self):
+        # Given two apps backed by different dbs
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        first_db = os.path.join(tmp_dir, 'first.db')
+        second_db = os.path.join(tmp_dir, 'second.db')
+        first_app = create_app({'DATABASE': first_db})
+        second_app = create_app({'DATABASE': second_db})
+        reading = json.dumps({
+            'type': 'temperature',
+            'value': 30,
+            'date_created': 1000
+        })
+
+        # When the same reading is uploaded to both
+        first = first_app.test_client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+        second = second_app.test_client().post('/devices/{}/readings/'.format(self.device_uuid), data=reading)
+
+        # Then each db stores it
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        for path in (first_db, second_db):
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute('select count(*) from readings').fetchone()[0], 1)
+            conn.close()
+
+        # And each app only counts its own readings
+        self.assertEqual(first_app.extensions['ingest_stats']['accepted'], 1)
+        self.assertEqual(second_app.extensions['ingest_stats']['accepted'], 1)
+
+    def test_init_db_column_added_concurrently(self):
+        # Given a db filled before readings were dated by the client
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+
+        # When another process adds the column between our check and ours
+        class RacingConnection(object):
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, sql, *args):
+                if sql.startswith('ALTER TABLE'):
+                    self.conn.execute(sql)
+                return self.conn.execute(sql, *args)
+
+            def commit(self):
+                self.conn.commit()
+
+        # Then the schema is still set up
+        self.assertTrue(init_db(RacingConnection(conn)))
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(readings)')]
+        self.assertIn('client_dated', columns)
+
+    def test_dedupe_readings(self):
+        # Given a db filled before ingest was idempotent
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        for _ in range(3):
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         (self.device_uuid, 'temperature', 22, 1000))
+        for _ in range(2):
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         (self.device_uuid, 'humidity', 22, 1000))
+
+        # The uniqueness index cannot be installed
+        self.assertFalse(init_db(conn))
+
+        # Readings dated by the server are left alone
+        for _ in range(2):
+            conn.execute('insert into readings (device_uuid,type,value,date_created,client_dated) VALUES (?,?,?,?,NULL)',
+                         (self.device_uuid, 'temperature', 22, 2000))
+
+        # When we dedupe the readings
+        removed = dedupe_readings(conn)
+
+        # Then only one reading per type and date is kept
+        self.assertEqual(removed, 3)
+        self.assertEqual(conn.execute('select count(*) from readings').fetchone()[0], 4)
+        self.assertTrue(init_db(conn))
+
+    def test_ready(self):
+        # Given an API to warm up, which waits for a process to serve it
+        warming_app = create_app({'TESTING': True, 'WARM_UP': True})
+        self.assertFalse(warming_app.extensions['warm_up'].is_set())
+
+        # When it serves its first request and the warm-up is done
+        warming_app.test_client().get('/ready/')
+        self.assertTrue(warming_app.extensions['warm_up'].wait(5))
+
+        # Then the API reports it is ready
+        request = warming_app.test_client().get('/ready/')
+        self.assertEqual(request.status_code, 200)
+
+    def test_ready_hot_window(self):
+        # Given an API warming up only its most active devices
+        warming_app = create_app({'TESTING': True, 'WARM_UP': True, 'WARM_UP_PAGE_CACHE': False})
+
+        # When it serves its first request and the warm-up is done
+        warming_app.test_client().get('/ready/')
+        self.assertTrue(warming_app.extensions['warm_up'].wait(5))
+
+        # Then the API reports it is ready
+        request = warming_app.test_client().get('/ready/')
+        self.assertEqual(request.status_code, 200)
+
+    def test_not_ready(self):
+        # Given an API that has not finished warming up
+        self.app.extensions['warm_up'].clear()
+        self.addCleanup(self.app.extensions['warm_up'].set)
+
+        # When we ask whether it is ready
+        request = self.client().get('/ready/')
+
+        # Then it asks to be left out of rotation
+        self.assertEqual(request.status_code, 503)
+
+    def test_warm_hot_window(self):
+        # Given a device with older readings and one with more recent ones
+        conn = sqlite3.connect('test_database.db')
+        latest = conn.execute('select max(date_created) from readings').fetchone()[0]
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('other_uuid', 'temperature', 30, latest - 5))
+        conn.commit()
+
+        # When we warm up the most active device over the last hour
+        # Then it is the device with the most readings
+        self.assertEqual(warm_hot_window(conn, 1, 60 * 60), [self.device_uuid])
+
+        # When we warm up the most active device over the last seconds
+        # Then the older readings are left out
+        self.assertEqual(warm_hot_window(conn, 1, 10), ['other_uuid'])
@@ -0,0 +1,35 @@
+import unittest
+
+from utils import RecentKeys
+
+
+class RecentKeysTestCases(unittest.TestCase):
+
+    def test_recent_keys_bounded(self):
+        # Given a filter that is full
+        keys = RecentKeys(maxsize=3)
+        for key in range(3):
+            keys.add(key)
+
+        # When a key is checked and another one added past maxsize
+        self.assertTrue(1 in keys)
+        keys.add(3)
+
+        # Then the least recently seen key is dropped
+        self.assertFalse(0 in keys)
+        self.assertTrue(1 in keys)
+        self.assertTrue(3 in keys)
+
+    def test_recent_keys_checked_key_survives(self):
+        # Given a filter that is full
+        keys = RecentKeys(maxsize=3)
+        for key in range(3):
+            keys.add(key)
+
+        # When the oldest key is checked before another one is added
+        self.assertTrue(0 in keys)
+        keys.add(3)
+
+        # Then the next oldest key is dropped instead
+        self.assertTrue(0 in keys)
+        self.assertFalse(1 in keys)
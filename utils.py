@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+
+
 def median(data_points):
     # we consider that the data_points have already been sorted
     mid = int(len(data_points) / 2)
@@ -7,3 +11,50 @@ def median(data_points):
     else:
         # odd: there is only one number
         return data_points[mid]
+
+
+class RecentKeys(object):
+    """
+    Bounded set remembering the most recently added keys, evicting the
+    least recently seen one once full. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+
+class Counters(object):
+    """
+    Named counters that can be incremented from several threads.
+    """
+
+    def __init__(self, *names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def increment(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)